@@ -1,11 +1,20 @@
 import os
+import io
+import re
+import math
 import pickle
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import geopandas.tools as gpt
 from datetime import timedelta
 from sklearn.linear_model import LinearRegression
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
+from PIL import Image
 
 # 環境変数読み込み
 ENV = os.environ.get("ENV")
@@ -17,6 +26,10 @@ RESPONSE_HEADERS = {
 
 FILE_NAME_KAIKA  = os.environ.get("FILE_NAME_KAIKA")
 FILE_NAME_MANKAI = os.environ.get("FILE_NAME_MANKAI")
+# 地域別モデルの振り分け用インデックス（未設定の場合は全国モデルのみで予測する）
+FILE_NAME_SHARD_INDEX = os.environ.get("FILE_NAME_SHARD_INDEX")
+# 日本の範囲のマスク（タイムラインの日本国内の判定・地図タイルの塗り分けに使う）
+FILE_NAME_JAPAN_MASK = os.environ.get("FILE_NAME_JAPAN_MASK", "japan_mask.sav")
 
 PATH_LOCAL_BUCKET = os.environ.get("PATH_LOCAL_BUCKET")
 
@@ -30,6 +43,68 @@ BASE_DATE = os.environ.get("BASE_DATE")
 BASE_DATE_DATETIME = pd.to_datetime(BASE_DATE)
 BASE_TIMEDELTA = timedelta(days=1)
 
+# 同時に届いた単一地点の予測リクエストをまとめる待ち時間（ミリ秒）
+# 0の場合はまとめずに1件ずつ予測する
+# 1インスタンスが複数リクエストを同時に処理する設定（第2世代・--concurrency）でのみ効果がある
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "0"))
+
+# 読み込み済みの予測モデル・日本の範囲のマスク・地域別モデルの振り分け用インデックス
+# 複数リクエストが同時にコールドスタートしても読み込みは1回だけ行う
+# 確認間隔（秒）ごとにファイルの更新世代を確認し、モデルが更新されていれば読み込み直す
+MODEL_CHECK_INTERVAL_SEC = float(os.environ.get("MODEL_CHECK_INTERVAL_SEC", "60"))
+models = None
+models_lock = threading.Lock()
+
+# 読み込み済みの地域別モデル（キー: ファイル名）
+# 使われた順に並べ、上限を超えたら最も使われていないモデルから破棄する
+# 上限の指定がない場合はインデックスにある地域別モデルを全て保持する
+SHARD_CACHE_SIZE = os.environ.get("SHARD_CACHE_SIZE")
+shard_models = OrderedDict()
+shard_models_lock = threading.Lock()
+# 読み込み中の地域別モデルのロック（キー: ファイル名、読み込みが終わったら削除する）
+shard_load_locks = {}
+# 地域別モデルがないマスの値（全国モデルで予測する）
+SHARD_NATIONWIDE = 255
+
+# タイムライン表示用の設定
+MODE_TIMELINE = "timeline"
+# 満開から葉桜になるまでの日数
+HAZAKURA_DAYS = int(os.environ.get("HAZAKURA_DAYS", "7"))
+# 1回のリクエストで指定できる日数・地点数の上限
+TIMELINE_MAX_DAYS   = 366
+TIMELINE_MAX_POINTS = 500
+# 日付の形式（YYYY-MM-DD）
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# 開花状況（インデックスは開花日・満開日・葉桜日を過ぎた数と対応する）
+STAGES = ["tsubomi", "kaika", "mankai", "hazakura"]
+
+# 地図タイル用の設定
+# パスは /{layer}/{z}/{x}/{y}.{format} の形式
+TILE_PATH_PATTERN = re.compile(r"^/?(?P<layer>[a-z]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.(?P<format>[a-z]+)$")
+TILE_LAYERS  = ["kaika", "mankai"]
+TILE_FORMATS = ["png", "bin"]
+TILE_CONTENT_TYPES = {"png": "image/png", "bin": "application/octet-stream"}
+TILE_SIZE  = 256
+TILE_MAX_Z = 12
+# binタイルは基準日からの日数をuint8で持ち、値なしは255とする
+TILE_NO_DATA = 255
+# pngタイルの色（TILE_DAYS_MINの日が薄いピンク、TILE_DAYS_MAXの日が濃いピンクになる）
+TILE_DAYS_MIN = 60
+TILE_DAYS_MAX = 130
+TILE_COLOR_EARLY = np.array([255, 235, 240])
+TILE_COLOR_LATE  = np.array([233, 30, 99])
+TILE_ALPHA = 200
+# Cloud Storageに保存するタイルのフォルダ
+TILE_DIR = "tiles"
+# メモリに保持するタイル数の上限
+TILE_CACHE_SIZE = int(os.environ.get("TILE_CACHE_SIZE", "128"))
+tiles = OrderedDict()
+tiles_lock = threading.Lock()
+# 作成中のタイルのロック（キー: タイルのファイル名、作成が終わったら削除する）
+tile_load_locks = {}
+# 日本の範囲を含まないタイル（フォーマットごとに1つだけメモリに持ち、Cloud Storageには保存しない）
+empty_tiles = {}
+
 def main(request):
   """
   メイン処理
@@ -44,6 +119,10 @@ def main(request):
   """
   query_parameter = request.args.to_dict()
 
+  # タイムラインモードの場合は期間内の開花状況を返す
+  if query_parameter.get("mode") == MODE_TIMELINE:
+    return main_timeline(query_parameter)
+
   #パラメータチェック
   check_obj = check_query_parameter(query_parameter)
   if not(check_obj["result"]):
@@ -53,17 +132,135 @@ def main(request):
   # クエリパラメータをもとに予測
   lat_param = float(query_parameter.get("lat"))
   lon_param = float(query_parameter.get("lon"))
-  forecast = forecast_date(lat_param, lon_param)
+  forecast = forecast_batcher.forecast(lat_param, lon_param)
 
   return (forecast, 200, RESPONSE_HEADERS)
 
+def main_timeline(query_parameter:dict):
+  """
+  タイムラインモードのメイン処理
+  1地点または複数地点について、指定期間の日ごとの開花状況を返す
+
+  Args:
+      query_parameter (dict): httpリクエストから取得したクエリパラメータ
+  Returns:
+      data(dict): 日付のリストと地点ごとの開花状況
+      status_code(int): httpステータスコード
+      headers(dict): httpヘッダー
+  """
+  #パラメータチェック
+  check_obj = check_timeline_query_parameter(query_parameter)
+  if not(check_obj["result"]):
+    # エラー返却
+    return (check_obj, check_obj["status_code"], RESPONSE_HEADERS)
+
+  # クエリパラメータをもとに予測
+  lat_params = [float(lat) for lat in split_list_param(query_parameter.get("lat"))]
+  lon_params = [float(lon) for lon in split_list_param(query_parameter.get("lon"))]
+  timeline = forecast_timeline(lat_params, lon_params, query_parameter.get("start"), query_parameter.get("end"))
+
+  return (timeline, 200, RESPONSE_HEADERS)
+
+
+def tile(request):
+  """
+  地図タイルの処理
+  HTTPが叩かれたときの入口
+  タイル内の全ピクセルの開花日・満開日をまとめて予測し、pngまたはbinで返す
+  作成したタイルはメモリとCloud Storageにモデルのバージョンごとにキャッシュする
+  日本の範囲を含まないタイルは、Cloud Storageを使わず共通の空のタイルを返す
 
-def check_query_parameter(query_parameter:dict):
+  Args:
+      request (Request):httpリクエスト
+  Returns:
+      data(bytes): タイルのデータ
+      status_code(int): httpステータスコード
+      headers(dict): httpヘッダー
+  """
+  #パラメータチェック
+  check_obj = check_tile_path(request.path)
+  if not(check_obj["result"]):
+    # エラー返却
+    return (check_obj, check_obj["status_code"], RESPONSE_HEADERS)
+
+  match = TILE_PATH_PATTERN.match(request.path)
+  layer, tile_format = match.group("layer"), match.group("format")
+  z, x, y = int(match.group("z")), int(match.group("x")), int(match.group("y"))
+  headers = {**RESPONSE_HEADERS, "Content-Type": TILE_CONTENT_TYPES[tile_format]}
+
+  # タイルの作成とキャッシュキーには同じバージョンのモデル一式を使う
+  model_set = open_model_set()
+
+  # 日本の範囲を含まないタイルは予測もCloud Storageへの保存もしない
+  lat_grid, lon_grid = get_tile_coordinates(z, x, y)
+  in_range = is_in_japan_mask(model_set["japan_mask"], lat_grid.ravel(), lon_grid.ravel()).reshape(lat_grid.shape)
+  if not(in_range.any()):
+    return (get_empty_tile(tile_format), 200, headers)
+
+  tile_name = f"{TILE_DIR}/{model_set['version']}/{layer}/{z}/{x}/{y}.{tile_format}"
+  tile_bytes = get_cached_tile(tile_name)
+  if tile_bytes is None:
+    tile_bytes = open_tile(tile_name, layer, tile_format, lat_grid, lon_grid, in_range, model_set)
+
+  return (tile_bytes, 200, headers)
+
+
+def check_tile_path(path:str):
+  """
+  地図タイルのパスが正常な値かチェックする
+
+  Args:
+      path (str): httpリクエストのパス
+
+  Returns:
+      dict: 検証結果・ステータスコード・エラーメッセージを格納するdict
+  """
+  match = TILE_PATH_PATTERN.match(path)
+  check_list = [
+    # パスが/{layer}/{z}/{x}/{y}.{format}の形式であること
+    {"function": is_exist, "param": match, "status_code": 404, "err_msg": "タイルのパスは/{layer}/{z}/{x}/{y}.{format}の形式で指定してください"},
+    # layer, formatが対応しているものであること
+    {"function": lambda m: m.group("layer") in TILE_LAYERS, "param": match, "status_code": 404, "err_msg": "layerはkaika, mankaiのいずれかを指定してください"},
+    {"function": lambda m: m.group("format") in TILE_FORMATS, "param": match, "status_code": 404, "err_msg": "formatはpng, binのいずれかを指定してください"},
+    # z, x, yがタイル座標として正しいこと
+    {"function": is_tile_coordinate, "param": match, "status_code": 404, "err_msg": f"zは{TILE_MAX_Z}以下、x, yは2^z未満を指定してください"},
+  ]
+
+  # 1つづつ検証してエラーが出たらその時点でチェック終了
+  for check in check_list:
+    if not(check["function"](check["param"])):
+      return {
+        "result": False,
+        "status_code": check["status_code"],
+        "err_msg": check["err_msg"]
+      }
+
+  return {
+    "result": True,
+    "status_code": 200,
+    "err_msg": None
+  }
+
+def is_tile_coordinate(match:re.Match):
+  """
+  z, x, yがタイル座標として正しいか（zが上限以下、x, yが0～2^z-1）を確認する
+
+  Args:
+      match (re.Match): タイルのパスのマッチ結果
+
+  Returns:
+      bool: タイル座標として正しいか
+  """
+  z, x, y = int(match.group("z")), int(match.group("x")), int(match.group("y"))
+  return z <= TILE_MAX_Z and x < 2 ** z and y < 2 ** z
+
+def check_query_parameter(query_parameter:dict, check_japan:bool=True):
   """
   クエリパラメータが正常な値かチェックする
 
   Args:
       query_parameter (dict): httpリクエストから取得したクエリパラメータ
+      check_japan (bool): 日本国内かどうかを逆ジオコーディングでチェックするか
 
   Returns:
       dict: 検証結果・ステータスコード・エラーメッセージを格納するdict
@@ -84,10 +281,10 @@ def check_query_parameter(query_parameter:dict):
     # lat, lonが範囲内であること
     {"function": is_latitude, "param": lat_param, "status_code": 400, "err_msg": "緯度は90以下を入力してください"},
     {"function": is_longitude, "param": lon_param, "status_code": 400, "err_msg": "経度は180以下を入力してください"},
-
-    # lat, lonが日本国内であること
-    {"function": is_japan, "param": {"lat": lat_param, "lon": lon_param}, "status_code": 400, "err_msg": "その地点は日本ではありません"}
   ]
+  if check_japan:
+    # lat, lonが日本国内であること
+    check_list.append({"function": is_japan, "param": {"lat": lat_param, "lon": lon_param}, "status_code": 400, "err_msg": "その地点は日本ではありません"})
 
   # 1つづつ検証してエラーが出たらその時点でチェック終了
   for check in check_list:
@@ -103,6 +300,79 @@ def check_query_parameter(query_parameter:dict):
     "err_msg": err_msg
   }
 
+def check_timeline_query_parameter(query_parameter:dict):
+  """
+  タイムラインモードのクエリパラメータが正常な値かチェックする
+  lat, lonはカンマ区切りで複数地点を指定できる
+  日本国内かどうかは地点ごとの逆ジオコーディングではなく、振り分け用インデックスでまとめて判定する
+
+  Args:
+      query_parameter (dict): httpリクエストから取得したクエリパラメータ
+
+  Returns:
+      dict: 検証結果・ステータスコード・エラーメッセージを格納するdict
+  """
+  start_param = query_parameter.get("start")
+  end_param = query_parameter.get("end")
+  lat_params = split_list_param(query_parameter.get("lat"))
+  lon_params = split_list_param(query_parameter.get("lon"))
+  check_list = [
+    # start, endが存在すること
+    {"function": is_exist, "param": start_param, "status_code": 400, "err_msg": "開始日が入力されていません"},
+    {"function": is_exist, "param": end_param, "status_code": 400, "err_msg": "終了日が入力されていません"},
+    # start, endが日付に変換できること
+    {"function": is_date, "param": start_param, "status_code": 400, "err_msg": "開始日はYYYY-MM-DD形式で入力してください"},
+    {"function": is_date, "param": end_param, "status_code": 400, "err_msg": "終了日はYYYY-MM-DD形式で入力してください"},
+    # 期間が正しいこと
+    {"function": is_date_range, "param": {"start": start_param, "end": end_param}, "status_code": 400, "err_msg": f"期間は開始日から{TIMELINE_MAX_DAYS}日以内で入力してください"},
+    # lat, lonの地点数が正しいこと
+    {"function": is_same_length, "param": {"lat": lat_params, "lon": lon_params}, "status_code": 400, "err_msg": "緯度と経度の数が一致していません"},
+    {"function": is_within_max_points, "param": lat_params, "status_code": 400, "err_msg": f"地点は{TIMELINE_MAX_POINTS}件以内で入力してください"},
+  ]
+
+  # 1つづつ検証してエラーが出たらその時点でチェック終了
+  for check in check_list:
+    if not(check["function"](check["param"])):
+      return {
+        "result": False,
+        "status_code": check["status_code"],
+        "err_msg": check["err_msg"]
+      }
+
+  # 地点ごとに緯度経度の値をチェックする
+  for lat_param, lon_param in zip(lat_params, lon_params):
+    check_obj = check_query_parameter({"lat": lat_param, "lon": lon_param}, check_japan=False)
+    if not(check_obj["result"]):
+      return check_obj
+
+  # 全地点が日本国内であること
+  if not(is_japan_points({"lat": lat_params, "lon": lon_params})):
+    return {
+      "result": False,
+      "status_code": 400,
+      "err_msg": "日本ではない地点が含まれています"
+    }
+
+  return {
+    "result": True,
+    "status_code": 200,
+    "err_msg": None
+  }
+
+def split_list_param(param:str):
+  """
+  カンマ区切りのクエリパラメータをリストに分割する
+
+  Args:
+      param (str): カンマ区切りのクエリパラメータ
+
+  Returns:
+      list: 分割したパラメータ（パラメータがない場合は要素1つのNoneのリスト）
+  """
+  if param is None:
+    return [None]
+  return [str.strip(value) for value in param.split(",")]
+
 def is_exist(param:any):
   """
   パラメータが存在する（Noneでない）ことを確認する
@@ -132,6 +402,64 @@ def is_float(param:str):
   else:
       return True
   
+def is_date(param:str):
+  """
+  文字列がYYYY-MM-DD形式の日付に変換できることを確認する
+
+  Args:
+      param (str): チェックするパラメータ
+
+  Returns:
+      bool: 文字列が日付に変換できるか
+  """
+  # 2024-3-1のような形式も変換できてしまうため、先に形式を確認する
+  if DATE_PATTERN.fullmatch(param) is None:
+    return False
+  try:
+      pd.to_datetime(param, format="%Y-%m-%d")
+  except ValueError:
+      return False
+  else:
+      return True
+
+def is_date_range(param:dict):
+  """
+  開始日が終了日以前で、期間が上限日数以内であることを確認する
+
+  Args:
+      param (dict): 開始日と終了日の情報を持つパラメータ
+
+  Returns:
+      bool: 期間が正しいか
+  """
+  start = pd.to_datetime(param.get("start"))
+  end = pd.to_datetime(param.get("end"))
+  return 0 <= (end - start) / BASE_TIMEDELTA < TIMELINE_MAX_DAYS
+
+def is_same_length(param:dict):
+  """
+  緯度と経度のリストの長さが一致することを確認する
+
+  Args:
+      param (dict): 緯度と経度のリストを持つパラメータ
+
+  Returns:
+      bool: 長さが一致するか
+  """
+  return len(param.get("lat")) == len(param.get("lon"))
+
+def is_within_max_points(param:list):
+  """
+  地点数が上限以内であることを確認する
+
+  Args:
+      param (list): 地点のリスト
+
+  Returns:
+      bool: 地点数が上限以内か
+  """
+  return len(param) <= TIMELINE_MAX_POINTS
+
 def is_latitude(param:str):
   """
   値が緯度として正しいか（-90度～90度）を確認する
@@ -184,6 +512,23 @@ def is_japan(param:dict):
   return str.strip(country) == "日本"
 
 
+def is_japan_points(param:dict):
+  """
+  複数地点の緯度経度が全て日本のものかを確認する
+  地点ごとに逆ジオコーディングするis_japanとは異なり、日本の範囲のマスクで近くに桜スポットがあるかをまとめて判定する
+  そのため、is_japanでは日本と判定される地点でも、桜スポットから遠い離島や海上などは日本ではないと判定される
+
+  Args:
+      param (dict): 緯度と経度のリストを持つパラメータ
+
+  Returns:
+      bool: 全地点の緯度経度が日本のものか
+  """
+  lat_array = np.asarray(param.get("lat"), dtype=float)
+  lon_array = np.asarray(param.get("lon"), dtype=float)
+  return bool(is_in_japan_mask(open_model_set()["japan_mask"], lat_array, lon_array).all())
+
+
 def forecast_date(lat_param:float, lon_param:float):
   """
   与えられた緯度と経度をもとに、桜の開花日・満開日を予測する
@@ -197,40 +542,522 @@ def forecast_date(lat_param:float, lon_param:float):
             {"kaika_date": "YYYY-MM-DD", "mankai_date": "YYYY-MM-DD"}
 
   """
-  # モデルをダンプしたファイルから取り出し
-  kaika_model, mankai_model = open_model()
+  return forecast_dates([lat_param], [lon_param])[0]
+
+def forecast_dates(lat_params:list, lon_params:list):
+  """
+  複数地点の緯度と経度をもとに、桜の開花日・満開日をまとめて予測する
+  モデルのpredictは全地点に対して1回だけ呼び出す
+
+  Args:
+      lat_params (list): 緯度のリスト
+      lon_params (list): 経度のリスト
+
+  Returns:
+      list: 地点ごとに以下のフォーマットで開花日・満開日を格納したdictのリスト
+            {"kaika_date": "YYYY-MM-DD", "mankai_date": "YYYY-MM-DD"}
+  """
+  kaika_days, mankai_days = predict_days(lat_params, lon_params)
+
+  kaika_dates  = plus_base_dates(kaika_days).strftime("%Y-%m-%d")
+  mankai_dates = plus_base_dates(mankai_days).strftime("%Y-%m-%d")
+
+  return [
+    {"kaika_date": kaika_date, "mankai_date": mankai_date}
+    for kaika_date, mankai_date in zip(kaika_dates, mankai_dates)
+  ]
+
+def forecast_timeline(lat_params:list, lon_params:list, start:str, end:str):
+  """
+  複数地点の緯度と経度をもとに、期間内の日ごとの開花状況を予測する
+  地点×日付の判定は配列演算でまとめて行う
+
+  Args:
+      lat_params (list): 緯度のリスト
+      lon_params (list): 経度のリスト
+      start (str): 開始日（YYYY-MM-DD形式）
+      end (str): 終了日（YYYY-MM-DD形式）
+
+  Returns:
+      dict: 以下のフォーマットで日付と地点ごとの開花状況を格納したdict
+            {"dates": ["YYYY-MM-DD", ...],
+             "timelines": [{"kaika_date": "YYYY-MM-DD", "mankai_date": "YYYY-MM-DD", "stages": ["tsubomi", ...]}, ...]}
+  """
+  kaika_days, mankai_days = predict_days(lat_params, lon_params)
+
+  # 予測日と同じく、基準日からの日数の小数点以下は切り捨てて日単位で比較する
+  kaika_days  = np.floor(kaika_days)
+  mankai_days = np.floor(mankai_days)
+  dates = pd.date_range(start, end, freq="D")
+  date_days = ((dates - BASE_DATE_DATETIME) / BASE_TIMEDELTA).to_numpy()
 
-  # 日数を予測
-  param = pd.DataFrame([{"lat":lat_param, "lon":lon_param}])
-  kaika_days  = kaika_model.predict(param)
-  mankai_days = mankai_model.predict(param)
+  # 地点×日付の配列で、開花日・満開日・葉桜日を過ぎた数が開花状況のインデックスになる
+  date_days = date_days[np.newaxis, :]
+  stage_index = (
+    (date_days >= kaika_days[:, np.newaxis]).astype(int)
+    + (date_days >= mankai_days[:, np.newaxis])
+    + (date_days >= mankai_days[:, np.newaxis] + HAZAKURA_DAYS)
+  )
+  stages = np.array(STAGES)[stage_index]
 
-  kaika_date  = plus_base_date(kaika_days[0])
-  mankai_date = plus_base_date(mankai_days[0])
+  kaika_dates  = plus_base_dates(kaika_days).strftime("%Y-%m-%d")
+  mankai_dates = plus_base_dates(mankai_days).strftime("%Y-%m-%d")
 
   return {
-    "kaika_date": kaika_date.strftime("%Y-%m-%d"),
-    "mankai_date": mankai_date.strftime("%Y-%m-%d")
+    "dates": list(dates.strftime("%Y-%m-%d")),
+    "timelines": [
+      {"kaika_date": kaika_date, "mankai_date": mankai_date, "stages": point_stages}
+      for kaika_date, mankai_date, point_stages in zip(kaika_dates, mankai_dates, stages.tolist())
+    ]
   }
 
-def open_model():
+def predict_days(lat_params:list, lon_params:list, model_set:dict=None):
   """
-  開花日・満開日の予測モデルをローカルファイルかCloudStorageから取得する
+  複数地点の緯度と経度をもとに、基準日から開花日・満開日までの日数を予測する
+
+  Args:
+      lat_params (list): 緯度のリスト
+      lon_params (list): 経度のリスト
+      model_set (dict): 予測に使うモデル一式（Noneの場合は最新のモデル一式を取得する）
+
+  Returns:
+      tuple: 開花日・満開日までの日数の配列
+  """
+  lat_array = np.asarray(lat_params, dtype=float)
+  lon_array = np.asarray(lon_params, dtype=float)
+
+  if model_set is None:
+    model_set = open_model_set()
+
+  # 地点ごとに予測に使う地域別モデルを決める
+  index = model_set["index"]
+  if index is None:
+    shard_numbers = np.full(len(lat_array), SHARD_NATIONWIDE)
+  else:
+    shard_numbers = route_shards(index, lat_array, lon_array)
+
+  # 地域別モデルごとにまとめて日数を予測
+  kaika_days  = np.empty(len(lat_array))
+  mankai_days = np.empty(len(lat_array))
+  for shard_number in np.unique(shard_numbers):
+    mask = shard_numbers == shard_number
+    if shard_number == SHARD_NATIONWIDE:
+      kaika_model, mankai_model = model_set["kaika_model"], model_set["mankai_model"]
+    else:
+      try:
+        kaika_model, mankai_model = open_shard_model(index["shards"][shard_number], get_shard_cache_size(index))
+      except (FileNotFoundError, NotFound):
+        # モデルの再作成で前のバージョンの地域別モデルが削除済みの場合は、モデル一式が更新されるまで全国モデルで予測する
+        kaika_model, mankai_model = model_set["kaika_model"], model_set["mankai_model"]
+
+    param = pd.DataFrame({"lat": lat_array[mask], "lon": lon_array[mask]})
+    kaika_days[mask]  = kaika_model.predict(param)
+    mankai_days[mask] = mankai_model.predict(param)
+  return kaika_days, mankai_days
+
+def route_shards(index:dict, lat_array:np.ndarray, lon_array:np.ndarray):
+  """
+  振り分け用インデックスのグリッドから、地点ごとの地域別モデルの番号を取得する
+  グリッドの範囲外の地点は全国モデルで予測する
+
+  Args:
+      index (dict): 地域別モデルの振り分け用インデックス
+      lat_array (np.ndarray): 緯度の配列
+      lon_array (np.ndarray): 経度の配列
+
+  Returns:
+      np.ndarray: 地点ごとの地域別モデルの番号
+  """
+  grid = index["grid"]
+  lat_i, lon_i, in_grid = get_grid_position(index, grid.shape, lat_array, lon_array)
+
+  shard_numbers = np.full(len(lat_array), SHARD_NATIONWIDE, dtype=grid.dtype)
+  shard_numbers[in_grid] = grid[lat_i[in_grid], lon_i[in_grid]]
+  return shard_numbers
+
+def is_in_japan_mask(japan_mask:dict, lat_array:np.ndarray, lon_array:np.ndarray):
+  """
+  日本の範囲のマスクから、地点ごとに日本の範囲かを判定する
+  グリッドの範囲外の地点は日本の範囲外とする
+
+  Args:
+      japan_mask (dict): 日本の範囲のマスク
+      lat_array (np.ndarray): 緯度の配列
+      lon_array (np.ndarray): 経度の配列
+
+  Returns:
+      np.ndarray: 地点ごとの日本の範囲かどうか
+  """
+  mask = japan_mask["mask"]
+  lat_i, lon_i, in_grid = get_grid_position(japan_mask, mask.shape, lat_array, lon_array)
+
+  in_japan = np.zeros(len(lat_array), dtype=bool)
+  in_japan[in_grid] = mask[lat_i[in_grid], lon_i[in_grid]]
+  return in_japan
+
+def get_grid_position(grid_info:dict, shape:tuple, lat_array:np.ndarray, lon_array:np.ndarray):
+  """
+  緯度経度からグリッドのマスの位置を取得する
+
+  Args:
+      grid_info (dict): グリッドの起点（lat_min, lon_min）と1マスの大きさ（grid_deg）を持つdict
+      shape (tuple): グリッドの大きさ（緯度方向, 経度方向）
+      lat_array (np.ndarray): 緯度の配列
+      lon_array (np.ndarray): 経度の配列
+
+  Returns:
+      List[np.ndarray, np.ndarray, np.ndarray]: 緯度方向の位置、経度方向の位置、グリッドの範囲内かどうか
+  """
+  lat_i = np.floor((lat_array - grid_info["lat_min"]) / grid_info["grid_deg"]).astype(int)
+  lon_i = np.floor((lon_array - grid_info["lon_min"]) / grid_info["grid_deg"]).astype(int)
+  in_grid = (0 <= lat_i) & (lat_i < shape[0]) & (0 <= lon_i) & (lon_i < shape[1])
+  return [lat_i, lon_i, in_grid]
+
+def get_tile_coordinates(z:int, x:int, y:int):
+  """
+  タイル内の全ピクセルの中心の緯度経度を取得する（Webメルカトル）
+
+  Args:
+      z (int): ズームレベル
+      x (int): タイルのx座標
+      y (int): タイルのy座標
+
+  Returns:
+      List[np.ndarray, np.ndarray]: ピクセルごとの緯度、経度
+  """
+  n = 2 ** z
+  pixels = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+  lons = (x + pixels) / n * 360 - 180
+  lats = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * (y + pixels) / n))))
+  lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+  return [lat_grid, lon_grid]
+
+def open_tile(tile_name:str, layer:str, tile_format:str, lat_grid:np.ndarray, lon_grid:np.ndarray, in_range:np.ndarray, model_set:dict):
+  """
+  タイルをCloud Storageから取得し、なければ作成して保存する
+  同じタイルの取得・作成は同時に1回だけ行い、結果はメモリにキャッシュする
+
+  Args:
+      tile_name (str): タイルのファイル名
+      layer (str): kaika（開花日）またはmankai（満開日）
+      tile_format (str): pngまたはbin
+      lat_grid (np.ndarray): ピクセルごとの緯度
+      lon_grid (np.ndarray): ピクセルごとの経度
+      in_range (np.ndarray): ピクセルごとの日本の範囲かどうか
+      model_set (dict): 予測に使うモデル一式
+
+  Returns:
+      bytes: タイルのデータ
+  """
+  with tiles_lock:
+    load_lock = tile_load_locks.setdefault(tile_name, threading.Lock())
+
+  with load_lock:
+    # 待っている間に他のリクエストが作成していればそれを使う
+    tile_bytes = get_cached_tile(tile_name)
+    if tile_bytes is not None:
+      return tile_bytes
+
+    try:
+      tile_bytes = open_bytes(tile_name)
+      if tile_bytes is None:
+        tile_bytes = create_tile(layer, tile_format, lat_grid, lon_grid, in_range, model_set)
+        dump_bytes(tile_bytes, tile_name, TILE_CONTENT_TYPES[tile_format])
+      set_cached_tile(tile_name, tile_bytes)
+    finally:
+      # タイルごとのロックは作成が終わったら残さない
+      with tiles_lock:
+        tile_load_locks.pop(tile_name, None)
+  return tile_bytes
+
+def create_tile(layer:str, tile_format:str, lat_grid:np.ndarray, lon_grid:np.ndarray, in_range:np.ndarray, model_set:dict):
+  """
+  タイル内の日本の範囲のピクセルの開花日・満開日をまとめて予測し、タイルを作成する
+  日本の範囲外のピクセルは値なしとする
+
+  Args:
+      layer (str): kaika（開花日）またはmankai（満開日）
+      tile_format (str): pngまたはbin
+      lat_grid (np.ndarray): ピクセルごとの緯度
+      lon_grid (np.ndarray): ピクセルごとの経度
+      in_range (np.ndarray): ピクセルごとの日本の範囲かどうか
+      model_set (dict): 予測に使うモデル一式
+
+  Returns:
+      bytes: タイルのデータ
+  """
+  values = np.full((TILE_SIZE, TILE_SIZE), TILE_NO_DATA, dtype=np.uint8)
+  kaika_days, mankai_days = predict_days(lat_grid[in_range], lon_grid[in_range], model_set)
+  days = kaika_days if layer == "kaika" else mankai_days
+  values[in_range] = np.clip(np.floor(days), 0, TILE_NO_DATA - 1)
+  return encode_tile(values, tile_format)
+
+def get_empty_tile(tile_format:str):
+  """
+  全ピクセルが値なしのタイルを取得する
+  フォーマットごとに1回だけ作成してメモリに保持する
+
+  Args:
+      tile_format (str): pngまたはbin
+
+  Returns:
+      bytes: タイルのデータ
+  """
+  if tile_format not in empty_tiles:
+    empty_tiles[tile_format] = encode_tile(np.full((TILE_SIZE, TILE_SIZE), TILE_NO_DATA, dtype=np.uint8), tile_format)
+  return empty_tiles[tile_format]
+
+def encode_tile(values:np.ndarray, tile_format:str):
+  """
+  基準日からの日数のタイルを指定のフォーマットに変換する
+
+  Args:
+      values (np.ndarray): 基準日からの日数（uint8、値なしはTILE_NO_DATA）
+      tile_format (str): pngまたはbin
+
+  Returns:
+      bytes: タイルのデータ
+  """
+  if tile_format == "bin":
+    return values.tobytes()
+  return encode_png_tile(values)
+
+def encode_png_tile(values:np.ndarray):
+  """
+  基準日からの日数のタイルを、日付に応じた色のpngに変換する
+
+  Args:
+      values (np.ndarray): 基準日からの日数（uint8、値なしはTILE_NO_DATA）
+
+  Returns:
+      bytes: pngのデータ
+  """
+  ratio = np.clip((values.astype(float) - TILE_DAYS_MIN) / (TILE_DAYS_MAX - TILE_DAYS_MIN), 0, 1)[:, :, np.newaxis]
+  rgba = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+  rgba[:, :, :3] = TILE_COLOR_EARLY + (TILE_COLOR_LATE - TILE_COLOR_EARLY) * ratio
+  rgba[:, :, 3] = np.where(values == TILE_NO_DATA, 0, TILE_ALPHA)
+
+  buffer = io.BytesIO()
+  Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG", optimize=True)
+  return buffer.getvalue()
+
+def get_cached_tile(tile_name:str):
+  """
+  メモリにキャッシュしたタイルを取得する
+
+  Args:
+      tile_name (str): タイルのファイル名
+
+  Returns:
+      bytes: タイルのデータ（キャッシュにない場合はNone）
+  """
+  with tiles_lock:
+    if tile_name not in tiles:
+      return None
+    tiles.move_to_end(tile_name)
+    return tiles[tile_name]
+
+def set_cached_tile(tile_name:str, tile_bytes:bytes):
+  """
+  タイルをメモリにキャッシュする
+  上限を超えたら最も使われていないタイルから破棄する
+
+  Args:
+      tile_name (str): タイルのファイル名
+      tile_bytes (bytes): タイルのデータ
+  """
+  with tiles_lock:
+    tiles[tile_name] = tile_bytes
+    tiles.move_to_end(tile_name)
+    while len(tiles) > TILE_CACHE_SIZE:
+      tiles.popitem(last=False)
+
+
+class ForecastBatcher:
+  """
+  短い待ち時間内に届いた単一地点の予測リクエストをまとめて予測する
+
+  最初に届いたリクエストが待ち時間だけ待機し、その間に届いたリクエストを
+  まとめてforecast_datesで予測する。後から届いたリクエストは結果が出るまで待つ。
+  """
+
+  def __init__(self, window_ms:float):
+    """
+    Args:
+        window_ms (float): リクエストをまとめる待ち時間（ミリ秒）
+    """
+    self.window_sec = window_ms / 1000
+    self.lock = threading.Lock()
+    self.pending = []
+
+  def forecast(self, lat_param:float, lon_param:float):
+    """
+    1地点の開花日・満開日を予測する
+    同時に届いた他のリクエストとまとめて予測される
+
+    Args:
+        lat_param (float): 緯度
+        lon_param (float): 経度
+
+    Returns:
+        dict: forecast_dateと同じフォーマットの開花日・満開日
+    """
+    if self.window_sec <= 0:
+      return forecast_date(lat_param, lon_param)
+
+    item = {"lat": lat_param, "lon": lon_param, "event": threading.Event(), "result": None, "error": None}
+    with self.lock:
+      self.pending.append(item)
+      is_leader = len(self.pending) == 1
+
+    if is_leader:
+      # 待ち時間の間に届いたリクエストをまとめて予測
+      time.sleep(self.window_sec)
+      with self.lock:
+        batch = self.pending
+        self.pending = []
+      self.run_batch(batch)
+    else:
+      item["event"].wait()
+
+    if item["error"] is not None:
+      raise item["error"]
+    return item["result"]
+
+  def run_batch(self, batch:list):
+    """
+    まとめたリクエストを1回のpredictで予測し、各リクエストに結果を渡す
+
+    Args:
+        batch (list): 予測待ちのリクエストのリスト
+    """
+    try:
+      results = forecast_dates([item["lat"] for item in batch], [item["lon"] for item in batch])
+      for item, result in zip(batch, results):
+        item["result"] = result
+    except Exception as e:
+      for item in batch:
+        item["error"] = e
+    finally:
+      # 失敗しても待っているリクエストは必ず解放する
+      for item in batch:
+        item["event"].set()
+
+forecast_batcher = ForecastBatcher(BATCH_WINDOW_MS)
+
+def open_model_set():
+  """
+  開花日・満開日の予測モデル、日本の範囲のマスク、地域別モデルの振り分け用インデックスを、
+  同じタイミングの一式としてローカルファイルかCloudStorageから取得する
+  読み込んだ一式はキャッシュし、確認間隔ごとにファイルが更新されていないか確認する
+
+  Returns:
+      dict: 以下のフォーマットのモデル一式
+            {"kaika_model": any, "mankai_model": any, "japan_mask": dict, "index": dict（地域別モデルを使わない場合はNone）,
+             "generations": list, "version": str, "checked_at": float}
+  """
+  global models
+  # 確認間隔内ならそのまま返す
+  current = models
+  if current is not None and time.monotonic() - current["checked_at"] < MODEL_CHECK_INTERVAL_SEC:
+    return current
+
+  # 同時に読み込みが走らないようロックを取り、取得後に再確認する
+  with models_lock:
+    if models is None or time.monotonic() - models["checked_at"] >= MODEL_CHECK_INTERVAL_SEC:
+      file_names = [FILE_NAME_KAIKA, FILE_NAME_MANKAI, FILE_NAME_JAPAN_MASK] + ([] if FILE_NAME_SHARD_INDEX is None else [FILE_NAME_SHARD_INDEX])
+      generations = [get_generation(file_name) for file_name in file_names]
+      if models is None or models["generations"] != generations:
+        # 確認した世代のファイルを読み込む
+        # 地域別モデルはインデックスにあるバージョン付きのファイル名で読み込むため、一式と食い違わない
+        files = [open_file(file_name, generation) for file_name, generation in zip(file_names, generations)]
+        models = {
+          "kaika_model": files[0],
+          "mankai_model": files[1],
+          "japan_mask": files[2],
+          "index": files[3] if FILE_NAME_SHARD_INDEX is not None else None,
+          "generations": generations,
+          "version": "-".join(str(generation) for generation in generations),
+          "checked_at": time.monotonic()
+        }
+      else:
+        models = dict(models, checked_at=time.monotonic())
+    return models
+
+def get_shard_cache_size(index:dict):
+  """
+  キャッシュする地域別モデルの上限数を取得する
+
+  Args:
+      index (dict): 地域別モデルの振り分け用インデックス
 
   Returns:
-      tuple: 開花日・満開日の予測モデル
+      int: キャッシュする地域別モデルの上限数
+  """
+  if SHARD_CACHE_SIZE is None:
+    return len(index["shards"])
+  return int(SHARD_CACHE_SIZE)
 
+def open_shard_model(file_name:str, cache_size:int):
   """
-  kaika_model = open_file(FILE_NAME_KAIKA)
-  mankai_model = open_file(FILE_NAME_MANKAI)
-  return [kaika_model, mankai_model]
+  地域別の開花日・満開日の予測モデルを、初めて使うときにローカルファイルかCloudStorageから取得する
+  取得したモデルは使われた順にキャッシュし、同じモデルの読み込みは同時に1回だけ行う
 
-def open_file(file_name:str):
+  Args:
+      file_name (str): 地域別モデルのファイル名
+      cache_size (int): キャッシュする地域別モデルの上限数
+
+  Returns:
+      list: 開花日・満開日の予測モデル
+  """
+  with shard_models_lock:
+    if file_name in shard_models:
+      shard_models.move_to_end(file_name)
+      return shard_models[file_name]
+    load_lock = shard_load_locks.setdefault(file_name, threading.Lock())
+
+  with load_lock:
+    # 待っている間に他のリクエストが読み込んでいればそれを使う
+    with shard_models_lock:
+      if file_name in shard_models:
+        shard_models.move_to_end(file_name)
+        return shard_models[file_name]
+
+    try:
+      model = open_file(file_name)
+      with shard_models_lock:
+        shard_models[file_name] = model
+        while len(shard_models) > cache_size:
+          shard_models.popitem(last=False)
+    finally:
+      # バージョンごとにファイル名が変わるため、読み込みが終わったロックは残さない
+      with shard_models_lock:
+        shard_load_locks.pop(file_name, None)
+  return model
+
+def get_generation(file_name:str):
+  """
+  ファイルの更新世代をローカルまたはCloud Storageから取得する
+  ローカルでは更新日時を世代として扱う
+
+  Args:
+      file_name (str): ファイル名
+
+  Returns:
+      int: ファイルの更新世代
+  """
+  if(ENV == "development"):
+    return os.stat(os.path.join(PATH_LOCAL_BUCKET, file_name)).st_mtime_ns
+  else:
+    return bucket.get_blob(file_name).generation
+
+def open_file(file_name:str, generation:int=None):
   """
   ファイルをローカルまたはCloud Storageから取得する
 
   Args:
       file_name (str): ファイル名
+      generation (int): 取得するCloud Storageの世代（Noneの場合は最新）
 
   Returns:
       Any: ローカルまたはCloud Storageから取得したファイル 
@@ -242,20 +1069,66 @@ def open_file(file_name:str):
       model = pickle.load(f)
   else:
     # 本番などの場合はGCPに接続
-    blob = bucket.blob(file_name)
+    blob = bucket.blob(file_name, generation=generation)
     model = pickle.loads(blob.download_as_string())
   
   return model
 
+def open_bytes(file_name:str):
+  """
+  バイト列のファイルをローカルまたはCloud Storageから取得する
+
+  Args:
+      file_name (str): ファイル名
+
+  Returns:
+      bytes: ローカルまたはCloud Storageから取得したファイル（存在しない場合はNone）
+  """
+  # 開発環境の場合はローカルファイルから取り出し
+  if(ENV == "development"):
+    path = os.path.join(PATH_LOCAL_BUCKET, file_name)
+    if not os.path.exists(path):
+      return None
+    with open(path, mode='rb') as f:
+      return f.read()
+  else:
+    # 本番などの場合はGCPに接続
+    blob = bucket.get_blob(file_name)
+    if blob is None:
+      return None
+    return blob.download_as_bytes()
+
+def dump_bytes(file:bytes, file_name:str, content_type:str):
+  """
+  バイト列のファイルをローカルまたはCloud Storageに保存する
+
+  Args:
+      file (bytes): 保存するデータ
+      file_name (str): ファイル名
+      content_type (str): Cloud Storageに保存するときのContent-Type
+
+  Returns:
+      None
+  """
+  if(ENV == "development"):
+    path = os.path.join(PATH_LOCAL_BUCKET, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='wb') as f:
+      f.write(file)
+  else:
+    # 本番モードではCloud Storageにアップロードする
+    blob = bucket.blob(file_name)
+    blob.upload_from_string(file, content_type=content_type)
+
 
-def plus_base_date(days:float) -> pd.Timestamp:
+def plus_base_dates(days:np.ndarray) -> pd.DatetimeIndex:
   """
-  基準日に日数を足した日付を取得する
+  基準日に日数の配列を足した日付をまとめて取得する
 
   Args:
-      days (float): 日数
+      days (np.ndarray): 日数の配列
 
   Returns:
-      pd.Timestamp: 基準日に日数を足した日付
+      pd.DatetimeIndex: 基準日に日数を足した日付
   """
-  return (BASE_DATE_DATETIME + BASE_TIMEDELTA * days)
+  return BASE_DATE_DATETIME + pd.to_timedelta(np.asarray(days, dtype=float), unit="D")
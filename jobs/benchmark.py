@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+
+# ベンチマークはローカルで実行するため、Cloud Storageには接続しない
+os.environ["ENV"] = "development"
+os.environ.setdefault("BASE_DATE", "2024-01-01")
+os.environ.setdefault("FILE_NAME_KAIKA", "model_kaika.sav")
+os.environ.setdefault("FILE_NAME_MANKAI", "model_mankai.sav")
+os.environ.setdefault("FILE_NAME_SHARD_INDEX", "model_shard_index.sav")
+
+from create_synthetic_data import create_synthetic_data
+
+# 計測する倍率（実データに対する地点数の倍率）
+# 10000倍はcsvが約19GB（約3.2億行）になり、読み込みに100GBを超えるメモリが必要なため既定では計測しない
+# 計測する場合は十分なディスク・メモリのあるマシンで倍率を指定して実行する（例: python jobs/benchmark.py 10000）
+DEFAULT_SCALES = [1, 100]
+# メモリ計測時のプロファイル設定
+# tracemallocは実行時間を大きく伸ばすため、実行時間の計測とは別に実行する
+MEMORY_PROFILE = "tracemalloc"
+
+
+def benchmark(scale:int, work_dir:str):
+  """
+  合成データを生成し、モデル作成の各ステージの実行時間・最大メモリ使用量を計測する
+  実行時間はプロファイルなし、最大メモリ使用量はtracemallocありで別々に実行して計測する
+
+  Args:
+      scale (int): 実データに対する地点数の倍率
+      work_dir (str): 合成データ・モデルの出力先フォルダ
+
+  Returns:
+      list: ステージごとの計測結果（実行時間は1回目、最大メモリ使用量は2回目の結果）
+  """
+  import create_model
+
+  data_dir = os.path.join(work_dir, f"x{scale}")
+  path_forecasts, path_places = create_synthetic_data(scale, data_dir)
+  time_stats = create_model.run(path_forecasts, path_places, profile=None)
+  memory_stats = create_model.run(path_forecasts, path_places, profile=MEMORY_PROFILE)
+  return [
+    dict(time_stat, peak_memory=memory_stat["peak_memory"])
+    for time_stat, memory_stat in zip(time_stats, memory_stats)
+  ]
+
+def print_result(scale:int, stats:list):
+  """
+  計測結果を表形式で出力する
+
+  Args:
+      scale (int): 実データに対する地点数の倍率
+      stats (list): ステージごとの計測結果
+  """
+  print(f"--- x{scale} ---")
+  print(f"{'stage':<16}{'seconds':>10}{'peak MiB':>12}")
+  for stat in stats:
+    peak_memory = "-" if stat["peak_memory"] is None else f"{stat['peak_memory'] / 1024 / 1024:.1f}"
+    print(f"{stat['stage']:<16}{stat['seconds']:>10.3f}{peak_memory:>12}")
+
+
+# メイン処理開始
+# 例: python jobs/benchmark.py 1 100
+if __name__ == "__main__":
+  scales = [int(scale) for scale in sys.argv[1:]] or DEFAULT_SCALES
+  with tempfile.TemporaryDirectory() as work_dir:
+    # モデルのダンプ先も一時フォルダにする
+    os.environ["PATH_LOCAL_BUCKET"] = work_dir
+    for scale in scales:
+      print_result(scale, benchmark(scale, work_dir))
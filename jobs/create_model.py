@@ -3,9 +3,16 @@ import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import mean_absolute_error as mae
+from sklearn.neighbors import BallTree
 from datetime import timedelta
 import pickle
 import os
+import re
+import shutil
+import time
+import cProfile
+import pstats
+import tracemalloc
 from google.cloud import storage
 
 # 環境変数読み込み
@@ -16,6 +23,10 @@ PATH_DATA_PLACES    = os.environ.get("PATH_DATA_PLACES")
 
 FILE_NAME_KAIKA  = os.environ.get("FILE_NAME_KAIKA")
 FILE_NAME_MANKAI = os.environ.get("FILE_NAME_MANKAI")
+# 地域別モデルの振り分け用インデックス（未設定の場合は地域別モデルを作成しない）
+FILE_NAME_SHARD_INDEX = os.environ.get("FILE_NAME_SHARD_INDEX")
+# 日本の範囲のマスク（地域別モデルの有無に関係なく常に作成する）
+FILE_NAME_JAPAN_MASK = os.environ.get("FILE_NAME_JAPAN_MASK", "japan_mask.sav")
 
 PATH_LOCAL_BUCKET = os.environ.get("PATH_LOCAL_BUCKET")
 
@@ -29,6 +40,13 @@ BASE_DATE = os.environ.get("BASE_DATE")
 BASE_DATE_DATETIME = pd.to_datetime(BASE_DATE)
 BASE_TIMEDELTA = timedelta(days=1)
 
+# ステージごとのプロファイル設定（"cprofile", "tracemalloc"をカンマ区切りで指定）
+PROFILE = os.environ.get("PROFILE")
+PROFILE_CPROFILE    = "cprofile"
+PROFILE_TRACEMALLOC = "tracemalloc"
+# cProfileの結果を表示する関数の数
+PROFILE_PRINT_LIMIT = 20
+
 TEST_SIZE = 0.2
 # TODO: LightGBMなどやるときの変数
 #EVAL_METRICS = "mae"
@@ -41,7 +59,31 @@ COL_PLACE_CODE = "place_code"
 COL_DATE       = "date"
 COL_KAIKA      = "kaika_date"
 COL_MANKAI     = "mankai_date"
-COLS_DROP = [COL_CODE, "meter", "tavg", "tmin", "tmax", "prcp", "prefecture_en", "prefecture_jp", "spot_name"]
+COL_PREFECTURE = "prefecture_en"
+COL_LAT        = "lat"
+COL_LON        = "lon"
+COLS_DROP = [COL_CODE, "meter", "tavg", "tmin", "tmax", "prcp", "prefecture_jp", "spot_name"]
+
+# 地域別モデルの設定
+# 地点数がこれより少ない都道府県は地域別モデルを作らず、全国モデルで予測する
+SHARD_MIN_ROWS = 10
+# 地域別モデルのファイル名（作成日時のバージョンを含め、作成済みのファイルは上書きしない）
+SHARD_FILE_NAME_FORMAT = "model_shard_{}_{}.sav"
+# 地域別モデルがないマスの値（全国モデルで予測する）
+SHARD_NATIONWIDE = 255
+
+# 振り分け用インデックス・日本の範囲のマスクのグリッド（日本全体を覆う範囲・1マスの大きさ（度））
+GRID_LAT_MIN  = 24.0
+GRID_LAT_MAX  = 46.0
+GRID_LON_MIN  = 122.0
+GRID_LON_MAX  = 146.0
+GRID_DEG = 0.1
+# 予測側が作成する地図タイルのフォルダ（モデルを作り直したら古いタイルは不要になる）
+TILE_DIR = "tiles"
+
+# 最も近い地点がこの距離以内のマスを日本の範囲とする（それより遠いマスは海・国外とみなす）
+JAPAN_MASK_MAX_DISTANCE_KM = 40
+EARTH_RADIUS_KM = 6371
 
 
 def create_linear_regression_model(df: pd.DataFrame, objectiv_col: str):
@@ -89,23 +131,55 @@ def split_data_frame(df:pd.DataFrame, objectiv_col:str):
   val_x = df_val.drop(objectiv_col, axis=1)
   return [train_x, train_y, val_x, val_y]
 
-def get_forecasts_data():
+def get_forecasts_data(path:str=PATH_DATA_FORECASTS):
   """
   開花予測データを取得する
 
+  Args:
+      path (str): 開花予測データのパス
+
   Returns:
       pd.DataFrame: 開花予測データ
   """
-  return pd.read_csv(PATH_DATA_FORECASTS)
+  return pd.read_csv(path)
 
-def get_places_data():
+def get_places_data(path:str=PATH_DATA_PLACES):
   """
   桜スポットの位置データを取得する
 
+  Args:
+      path (str): 桜スポットの位置データのパス
+
   Returns:
       pd.DataFrame: 桜スポットの位置データ
   """
-  return pd.read_csv(PATH_DATA_PLACES)
+  return pd.read_csv(path)
+
+def ingest_data(path_forecasts:str=PATH_DATA_FORECASTS, path_places:str=PATH_DATA_PLACES):
+  """
+  開花予測データと桜スポットの位置データを読み込む
+
+  Args:
+      path_forecasts (str): 開花予測データのパス
+      path_places (str): 桜スポットの位置データのパス
+
+  Returns:
+      List[pd.DataFrame, pd.DataFrame]: 開花予測データ、桜スポットの位置データ
+  """
+  return [get_forecasts_data(path_forecasts), get_places_data(path_places)]
+
+def merge_data(df_forecasts:pd.DataFrame, df_places:pd.DataFrame):
+  """
+  開花予測データに桜スポットの位置データを結合する
+
+  Args:
+      df_forecasts (pd.DataFrame): 開花予測データ
+      df_places (pd.DataFrame): 桜スポットの位置データ
+
+  Returns:
+      pd.DataFrame: 予測用データ
+  """
+  return pd.merge(df_forecasts, df_places, left_on=COL_PLACE_CODE, right_on=COL_CODE)
 
 def get_data():
   """
@@ -114,10 +188,8 @@ def get_data():
   Returns:
       pd.DataFrame: 予測用データ
   """
-  df_forecasts = get_forecasts_data()
-  df_places = get_places_data()
-  df = pd.merge(df_forecasts, df_places, left_on=COL_PLACE_CODE, right_on=COL_CODE)
-  return df
+  df_forecasts, df_places = ingest_data()
+  return merge_data(df_forecasts, df_places)
 
 
 def minus_base_date(date_str:str):
@@ -159,6 +231,179 @@ def preprocess_data(df: pd.DataFrame):
   
   return ret_df
 
+def create_models(df: pd.DataFrame):
+  """
+  開花日・満開日の予測モデルを作成する
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+
+  Returns:
+      List[any, any]: 開花日・満開日の予測モデル
+  """
+  # 地域別モデル用の列は全国モデルでは使わない
+  df = df.drop(columns=COL_PREFECTURE)
+  # データから満開日のデータを削ったデータで、開花日を予測するモデルを作成
+  kaika_model  = create_linear_regression_model(df.drop(columns=COL_MANKAI), COL_KAIKA)
+  # 開花日を削ったデータで、満開日を予測するモデルを作成
+  mankai_model = create_linear_regression_model(df.drop(columns=COL_KAIKA), COL_MANKAI)
+  return [kaika_model, mankai_model]
+
+def create_shard_models(df: pd.DataFrame):
+  """
+  都道府県ごとに開花日・満開日の予測モデルを作成する
+  地点数が少ない都道府県は全国モデルで予測するため作成しない
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+
+  Returns:
+      dict: 都道府県名をキー、開花日・満開日の予測モデルのリストを値とするdict
+  """
+  shard_models = {}
+  for prefecture, df_prefecture in df.groupby(COL_PREFECTURE):
+    if len(df_prefecture) < SHARD_MIN_ROWS:
+      continue
+    print(prefecture)
+    shard_models[prefecture] = create_models(df_prefecture)
+  return shard_models
+
+def create_shard_file_name(prefecture:str, version:str):
+  """
+  都道府県名から地域別モデルのファイル名を作成する
+
+  Args:
+      prefecture (str): 都道府県名
+      version (str): 地域別モデルのバージョン
+
+  Returns:
+      str: 地域別モデルのファイル名
+  """
+  return SHARD_FILE_NAME_FORMAT.format(version, re.sub("[^0-9a-z]+", "_", prefecture.lower()).strip("_"))
+
+def get_unique_places(df: pd.DataFrame):
+  """
+  同じ座標の地点を1つにまとめた地点データを取得する
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+
+  Returns:
+      pd.DataFrame: 緯度・経度・都道府県名の地点データ
+  """
+  return df[[COL_LAT, COL_LON, COL_PREFECTURE]].drop_duplicates(subset=[COL_LAT, COL_LON])
+
+def find_nearest_places(df_places: pd.DataFrame):
+  """
+  日本全体を覆うグリッドの全マスについて、マスの中心から最も近い地点とその距離を求める
+  地点の木構造を作り、全マスを1回で検索する（球面上の距離で比較する）
+
+  Args:
+      df_places (pd.DataFrame): 同じ座標の地点を1つにまとめた地点データ
+
+  Returns:
+      List[np.ndarray, np.ndarray]: 緯度方向×経度方向の最も近い地点の行番号、距離（km）
+  """
+  # マスの中心の緯度経度
+  grid_lats = np.arange(GRID_LAT_MIN, GRID_LAT_MAX, GRID_DEG) + GRID_DEG / 2
+  grid_lons = np.arange(GRID_LON_MIN, GRID_LON_MAX, GRID_DEG) + GRID_DEG / 2
+  grid_lat, grid_lon = np.meshgrid(grid_lats, grid_lons, indexing="ij")
+
+  tree = BallTree(np.radians(df_places[[COL_LAT, COL_LON]].to_numpy()), metric="haversine")
+  distances, nearest = tree.query(np.radians(np.column_stack([grid_lat.ravel(), grid_lon.ravel()])), k=1)
+  return [nearest[:, 0].reshape(grid_lat.shape), (distances[:, 0] * EARTH_RADIUS_KM).reshape(grid_lat.shape)]
+
+def create_routing_index(df: pd.DataFrame, prefectures:list, version:str):
+  """
+  緯度経度から地域別モデルを選ぶための振り分け用インデックスを作成する
+  日本全体を覆うグリッドの各マスに、最も近い地点の都道府県のモデル番号を持たせる
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+      prefectures (list): 地域別モデルを作成した都道府県名のリスト
+      version (str): 地域別モデルのバージョン
+
+  Returns:
+      dict: 以下のフォーマットの振り分け用インデックス
+            {"lat_min": float, "lon_min": float, "grid_deg": float,
+             "grid": np.ndarray(uint8, 緯度方向×経度方向のモデル番号), "shards": [地域別モデルのファイル名, ...]}
+  """
+  # 地点ごとのモデル番号（地域別モデルがない都道府県は全国モデル）
+  df_places = get_unique_places(df)
+  shard_numbers = {prefecture: i for i, prefecture in enumerate(prefectures)}
+  place_shards = df_places[COL_PREFECTURE].map(shard_numbers).fillna(SHARD_NATIONWIDE).to_numpy(dtype=np.uint8)
+
+  nearest, _ = find_nearest_places(df_places)
+  return {
+    "lat_min": GRID_LAT_MIN,
+    "lon_min": GRID_LON_MIN,
+    "grid_deg": GRID_DEG,
+    "grid": place_shards[nearest],
+    "shards": [create_shard_file_name(prefecture, version) for prefecture in prefectures]
+  }
+
+def create_japan_mask(df: pd.DataFrame):
+  """
+  緯度経度が日本の範囲かを判定するためのマスクを作成する
+  日本全体を覆うグリッドの各マスについて、最も近い桜スポットが一定距離以内かを持たせる
+  （逆ジオコーディングとは異なり、スポットから遠い離島や海上・グリッドの範囲外は日本の範囲外になる）
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+
+  Returns:
+      dict: 以下のフォーマットのマスク
+            {"lat_min": float, "lon_min": float, "grid_deg": float,
+             "mask": np.ndarray(bool, 緯度方向×経度方向の日本の範囲かどうか)}
+  """
+  _, distances = find_nearest_places(get_unique_places(df))
+  return {
+    "lat_min": GRID_LAT_MIN,
+    "lon_min": GRID_LON_MIN,
+    "grid_deg": GRID_DEG,
+    "mask": distances <= JAPAN_MASK_MAX_DISTANCE_KM
+  }
+
+def dump_japan_mask(df: pd.DataFrame):
+  """
+  日本の範囲のマスクをファイルとして保存する
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+
+  Returns:
+      None
+  """
+  dump_file(create_japan_mask(df), FILE_NAME_JAPAN_MASK)
+
+def dump_shard_models(df: pd.DataFrame, shard_models:dict):
+  """
+  地域別モデルと振り分け用インデックスをファイルとして保存する
+  地域別モデルは開花日・満開日のモデルを1ファイルにまとめ、1回の取得で済むようにする
+  保存後、前のバージョンの地域別モデルは削除する
+
+  Args:
+      df (pd.DataFrame): 前処理を行ったデータ
+      shard_models (dict): 都道府県名をキー、開花日・満開日の予測モデルのリストを値とするdict
+
+  Returns:
+      None
+  """
+  # ファイル名にバージョンを含め、予測側が古いインデックスと新しいモデルを組み合わせないようにする
+  version = time.strftime("%Y%m%d%H%M%S")
+  previous_index = load_file(FILE_NAME_SHARD_INDEX)
+  prefectures = list(shard_models.keys())
+  for prefecture in prefectures:
+    dump_file(shard_models[prefecture], create_shard_file_name(prefecture, version))
+  # インデックスはモデルを全て保存してから更新する
+  index = create_routing_index(df, prefectures, version)
+  dump_file(index, FILE_NAME_SHARD_INDEX)
+
+  # 新しいインデックスを保存した後、前のバージョンの地域別モデルを削除する
+  if previous_index is not None:
+    for file_name in set(previous_index["shards"]) - set(index["shards"]):
+      delete_file(file_name)
+
 def dump_model(kaika_model:any, mankai_model:any):
   """
   作成したモデルをファイルとして保存する
@@ -194,15 +439,141 @@ def dump_file(file: any, file_name: str):
     file_byte = pickle.dumps(file)
     blob.upload_from_string(file_byte, content_type='application/octet-stream')
 
+def load_file(file_name: str):
+  """
+  ファイルをローカルまたはCloud Storageから取得する
 
-# メイン処理開始
-df = preprocess_data(get_data())
+  Args:
+      file_name (str): ファイル名
+
+  Returns:
+      any: 取得したファイル（存在しない場合はNone）
+  """
+  if ENV == "development":
+    path = os.path.join(PATH_LOCAL_BUCKET, file_name)
+    if not os.path.exists(path):
+      return None
+    with open(path, mode='rb') as f:
+      return pickle.load(f)
+  else:
+    blob = bucket.get_blob(file_name)
+    if blob is None:
+      return None
+    return pickle.loads(blob.download_as_bytes())
+
+def delete_file(file_name: str):
+  """
+  ファイルをローカルまたはCloud Storageから削除する
 
-# データから満開日のデータを削ったデータで、開花日を予測するモデルを作成
-kaika_model  = create_linear_regression_model(df.drop(columns=COL_MANKAI), COL_KAIKA)
-# 開花日を削ったデータで、満開日を予測するモデルを作成
-mankai_model = create_linear_regression_model(df.drop(columns=COL_KAIKA), COL_MANKAI)
+  Args:
+      file_name (str): ファイル名
+
+  Returns:
+      None
+  """
+  if ENV == "development":
+    path = os.path.join(PATH_LOCAL_BUCKET, file_name)
+    if os.path.exists(path):
+      os.remove(path)
+  else:
+    blob = bucket.get_blob(file_name)
+    if blob is not None:
+      blob.delete()
+
+def delete_tiles():
+  """
+  予測側が作成した地図タイルをローカルまたはCloud Storageから全て削除する
+  タイルはモデルのバージョンごとに保存されるため、モデルを作り直したら古いタイルは使われない
+
+  Returns:
+      None
+  """
+  if ENV == "development":
+    shutil.rmtree(os.path.join(PATH_LOCAL_BUCKET, TILE_DIR), ignore_errors=True)
+  else:
+    for blob in bucket.list_blobs(prefix=f"{TILE_DIR}/"):
+      blob.delete()
 
-#モデルの保存
-dump_model(kaika_model, mankai_model)
 
+def run_stage(stage_name:str, function:callable, *args, profile:str=None):
+  """
+  処理を1ステージとして実行し、実行時間を計測する
+  profileの指定に応じてcProfile・tracemallocで計測する
+
+  Args:
+      stage_name (str): ステージ名
+      function (callable): 実行する処理
+      *args: 処理に渡す引数
+      profile (str): プロファイル設定（"cprofile", "tracemalloc"をカンマ区切りで指定）
+
+  Returns:
+      List[any, dict]: 処理の戻り値、ステージ名・実行時間（秒）・最大メモリ使用量（バイト）を格納したdict
+  """
+  profiles = [] if profile is None else [str.strip(p) for p in profile.split(",")]
+  use_tracemalloc = PROFILE_TRACEMALLOC in profiles
+  profiler = cProfile.Profile() if PROFILE_CPROFILE in profiles else None
+
+  if use_tracemalloc:
+    tracemalloc.start()
+  if profiler is not None:
+    profiler.enable()
+  start = time.perf_counter()
+  try:
+    result = function(*args)
+  finally:
+    seconds = time.perf_counter() - start
+    if profiler is not None:
+      profiler.disable()
+    peak_memory = None
+    if use_tracemalloc:
+      _, peak_memory = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+  print(f"{stage_name}: {seconds:.3f}s" + ("" if peak_memory is None else f", peak {peak_memory / 1024 / 1024:.1f}MiB"))
+  if profiler is not None:
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(PROFILE_PRINT_LIMIT)
+
+  return [result, {"stage": stage_name, "seconds": seconds, "peak_memory": peak_memory}]
+
+def run(path_forecasts:str=PATH_DATA_FORECASTS, path_places:str=PATH_DATA_PLACES, profile:str=PROFILE):
+  """
+  データ取得からモデル保存までをステージごとに実行する
+
+  Args:
+      path_forecasts (str): 開花予測データのパス
+      path_places (str): 桜スポットの位置データのパス
+      profile (str): プロファイル設定（"cprofile", "tracemalloc"をカンマ区切りで指定）
+
+  Returns:
+      list: ステージごとの計測結果
+  """
+  stats = []
+  (df_forecasts, df_places), stat = run_stage("ingest", ingest_data, path_forecasts, path_places, profile=profile)
+  stats.append(stat)
+  df, stat = run_stage("merge", merge_data, df_forecasts, df_places, profile=profile)
+  stats.append(stat)
+  df, stat = run_stage("preprocess", preprocess_data, df, profile=profile)
+  stats.append(stat)
+  (kaika_model, mankai_model), stat = run_stage("fit", create_models, df, profile=profile)
+  stats.append(stat)
+  _, stat = run_stage("dump", dump_model, kaika_model, mankai_model, profile=profile)
+  stats.append(stat)
+  _, stat = run_stage("dump_japan_mask", dump_japan_mask, df, profile=profile)
+  stats.append(stat)
+
+  # 地域別モデルの作成・保存
+  if FILE_NAME_SHARD_INDEX is not None:
+    shard_models, stat = run_stage("fit_shards", create_shard_models, df, profile=profile)
+    stats.append(stat)
+    _, stat = run_stage("dump_shards", dump_shard_models, df, shard_models, profile=profile)
+    stats.append(stat)
+
+  # モデルを全て保存した後、古いバージョンの地図タイルを削除する
+  _, stat = run_stage("delete_tiles", delete_tiles, profile=profile)
+  stats.append(stat)
+  return stats
+
+
+# メイン処理開始
+if __name__ == "__main__":
+  run()
@@ -0,0 +1,167 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# 実データ（japan-cherry-blossoms-forecasts-2024）の規模
+# 1倍で約1000地点×32日分のデータになる
+BASE_PLACE_COUNT = 1004
+DATE_START = "2024-02-01"
+DATE_COUNT = 32
+
+# 出力先ファイル名（jobs/create_model.pyが読み込むcsvと同じ名前）
+FILE_NAME_FORECASTS = "cherry_blossom_forecasts.csv"
+FILE_NAME_PLACES    = "cherry_blossom_places.csv"
+
+# 1回に生成・書き込みする地点数（大きな倍率でもメモリに載り切るように分割する）
+CHUNK_PLACE_COUNT = 10000
+
+SEED = 0
+
+# 都道府県名と県庁所在地のおおよその緯度経度
+PREFECTURES = [
+  ("北海道", "Hokkaido", 43.06, 141.35),
+  ("青森県", "Aomori Prefecture", 40.82, 140.74),
+  ("岩手県", "Iwate Prefecture", 39.70, 141.15),
+  ("宮城県", "Miyagi Prefecture", 38.27, 140.87),
+  ("秋田県", "Akita Prefecture", 39.72, 140.10),
+  ("山形県", "Yamagata Prefecture", 38.24, 140.36),
+  ("福島県", "Fukushima Prefecture", 37.75, 140.47),
+  ("茨城県", "Ibaraki Prefecture", 36.34, 140.45),
+  ("栃木県", "Tochigi Prefecture", 36.57, 139.88),
+  ("群馬県", "Gunma Prefecture", 36.39, 139.06),
+  ("埼玉県", "Saitama Prefecture", 35.86, 139.65),
+  ("千葉県", "Chiba Prefecture", 35.61, 140.12),
+  ("東京都", "Tokyo Metropolis", 35.69, 139.69),
+  ("神奈川県", "Kanagawa Prefecture", 35.45, 139.64),
+  ("新潟県", "Niigata Prefecture", 37.90, 139.02),
+  ("富山県", "Toyama Prefecture", 36.70, 137.21),
+  ("石川県", "Ishikawa Prefecture", 36.59, 136.63),
+  ("福井県", "Fukui Prefecture", 36.07, 136.22),
+  ("山梨県", "Yamanashi Prefecture", 35.66, 138.57),
+  ("長野県", "Nagano Prefecture", 36.65, 138.18),
+  ("岐阜県", "Gifu Prefecture", 35.39, 136.72),
+  ("静岡県", "Shizuoka Prefecture", 34.98, 138.38),
+  ("愛知県", "Aichi Prefecture", 35.18, 136.91),
+  ("三重県", "Mie Prefecture", 34.73, 136.51),
+  ("滋賀県", "Shiga Prefecture", 35.00, 135.87),
+  ("京都府", "Kyoto Prefecture", 35.02, 135.76),
+  ("大阪府", "Osaka Prefecture", 34.69, 135.52),
+  ("兵庫県", "Hyogo Prefecture", 34.69, 135.18),
+  ("奈良県", "Nara Prefecture", 34.69, 135.83),
+  ("和歌山県", "Wakayama Prefecture", 34.23, 135.17),
+  ("鳥取県", "Tottori Prefecture", 35.50, 134.24),
+  ("島根県", "Shimane Prefecture", 35.47, 133.05),
+  ("岡山県", "Okayama Prefecture", 34.66, 133.93),
+  ("広島県", "Hiroshima Prefecture", 34.40, 132.46),
+  ("山口県", "Yamaguchi Prefecture", 34.19, 131.47),
+  ("徳島県", "Tokushima Prefecture", 34.07, 134.56),
+  ("香川県", "Kagawa Prefecture", 34.34, 134.04),
+  ("愛媛県", "Ehime Prefecture", 33.84, 132.77),
+  ("高知県", "Kochi Prefecture", 33.56, 133.53),
+  ("福岡県", "Fukuoka Prefecture", 33.61, 130.42),
+  ("佐賀県", "Saga Prefecture", 33.25, 130.30),
+  ("長崎県", "Nagasaki Prefecture", 32.74, 129.87),
+  ("熊本県", "Kumamoto Prefecture", 32.79, 130.74),
+  ("大分県", "Oita Prefecture", 33.24, 131.61),
+  ("宮崎県", "Miyazaki Prefecture", 31.91, 131.42),
+  ("鹿児島県", "Kagoshima Prefecture", 31.56, 130.56),
+  ("沖縄県", "Okinawa Prefecture", 26.21, 127.68),
+]
+
+
+def create_places_data(rng:np.random.Generator, start_code:int, place_count:int):
+  """
+  桜スポットの位置データと同じ形式のデータを生成する
+  各地点はランダムな都道府県の県庁所在地の周辺に配置する
+
+  Args:
+      rng (np.random.Generator): 乱数生成器
+      start_code (int): 地点コードの開始番号
+      place_count (int): 生成する地点数
+
+  Returns:
+      pd.DataFrame: 桜スポットの位置データ
+  """
+  prefecture_index = rng.integers(0, len(PREFECTURES), place_count)
+  prefecture_jp, prefecture_en, lat_center, lon_center = [np.array(col) for col in zip(*PREFECTURES)]
+  codes = np.arange(start_code, start_code + place_count)
+
+  return pd.DataFrame({
+    "code": codes,
+    "prefecture_jp": prefecture_jp[prefecture_index],
+    "prefecture_en": prefecture_en[prefecture_index],
+    "spot_name": [f"spot_{code}" for code in codes],
+    "lat": lat_center[prefecture_index].astype(float) + rng.normal(0, 0.3, place_count),
+    "lon": lon_center[prefecture_index].astype(float) + rng.normal(0, 0.3, place_count),
+  })
+
+def create_forecasts_data(rng:np.random.Generator, df_places:pd.DataFrame):
+  """
+  開花予測データと同じ形式のデータを生成する
+  開花日は緯度が高いほど遅くなるようにし、満開日は開花日の数日後とする
+
+  Args:
+      rng (np.random.Generator): 乱数生成器
+      df_places (pd.DataFrame): 桜スポットの位置データ
+
+  Returns:
+      pd.DataFrame: 開花予測データ
+  """
+  place_count = len(df_places)
+  row_count = place_count * DATE_COUNT
+  dates = pd.date_range(DATE_START, periods=DATE_COUNT, freq="D")
+
+  # 予測日ごとに開花日が少しずつぶれるようにする
+  kaika_days = 83 + 3.5 * (df_places["lat"].to_numpy() - 35.7) + 0.5 * (df_places["lon"].to_numpy() - 136.9)
+  kaika_days = np.repeat(kaika_days, DATE_COUNT) + rng.normal(0, 2, row_count)
+  mankai_days = kaika_days + rng.uniform(4, 10, row_count)
+  base_date = pd.to_datetime(DATE_START).replace(month=1, day=1)
+  tavg = 6 - 0.8 * (np.repeat(df_places["lat"].to_numpy(), DATE_COUNT) - 35.7) + rng.normal(0, 3, row_count)
+
+  return pd.DataFrame({
+    "place_code": np.repeat(df_places["code"].to_numpy(), DATE_COUNT),
+    "date": np.tile(dates.strftime("%Y-%m-%d"), place_count),
+    "mankai_date": (base_date + pd.to_timedelta(np.floor(mankai_days), unit="D")).strftime("%Y-%m-%d"),
+    "kaika_date": (base_date + pd.to_timedelta(np.floor(kaika_days), unit="D")).strftime("%Y-%m-%d"),
+    "meter": np.tile(np.arange(DATE_COUNT), place_count) + rng.integers(0, 30, row_count),
+    "tavg": np.round(tavg, 1),
+    "tmin": np.round(tavg - rng.uniform(2, 6, row_count), 1),
+    "tmax": np.round(tavg + rng.uniform(2, 6, row_count), 1),
+    "prcp": np.round(rng.exponential(4, row_count), 1),
+  })
+
+def create_synthetic_data(scale:int, out_dir:str):
+  """
+  開花予測データ・桜スポットの位置データを実データのscale倍の地点数で生成し、csvに出力する
+
+  Args:
+      scale (int): 実データに対する地点数の倍率
+      out_dir (str): 出力先フォルダ
+
+  Returns:
+      List[str, str]: 開花予測データ、桜スポットの位置データのパス
+  """
+  os.makedirs(out_dir, exist_ok=True)
+  path_forecasts = os.path.join(out_dir, FILE_NAME_FORECASTS)
+  path_places    = os.path.join(out_dir, FILE_NAME_PLACES)
+
+  rng = np.random.default_rng(SEED)
+  place_count = BASE_PLACE_COUNT * scale
+  # 地点を分割して生成し、csvに追記していく
+  for start in range(0, place_count, CHUNK_PLACE_COUNT):
+    chunk_count = min(CHUNK_PLACE_COUNT, place_count - start)
+    df_places = create_places_data(rng, start + 1, chunk_count)
+    df_forecasts = create_forecasts_data(rng, df_places)
+
+    is_first = start == 0
+    df_places.to_csv(path_places, mode="w" if is_first else "a", header=is_first, index=False)
+    df_forecasts.to_csv(path_forecasts, mode="w" if is_first else "a", header=is_first, index=False)
+
+  return [path_forecasts, path_places]
+
+
+# メイン処理開始
+# 例: python jobs/create_synthetic_data.py 100 data/synthetic
+if __name__ == "__main__":
+  create_synthetic_data(int(sys.argv[1]), sys.argv[2])